@@ -1,7 +1,7 @@
 from typing import Optional
 
-from fuse_cdm.main import Checksums, AccessMethods, Contents
-from pydantic import BaseModel
+from fuse_cdm.main import Checksums, AccessMethods, Contents, as_form
+from pydantic import BaseModel, EmailStr, Field
 
 
 class ProviderResponse(BaseModel):
@@ -25,3 +25,11 @@ class ProviderResponse(BaseModel):
     contents: Optional[list[Contents]] = None,
     data_type: Optional[str] = None,
     stderr: Optional[str] = None
+
+
+@as_form
+class BatchProviderParameters(BaseModel):
+    service_id: str = Field(..., title="Provider service id", description="id of service used to upload these objects")
+    submitter_id: EmailStr = Field(..., title="email", description="unique submitter id (email)")
+    accession_ids: str = Field(..., title="External accession IDs", description="comma-separated ImmuneSpace participant groups to download")
+    apikey: str = Field(..., title="External apikey", description="the apikey used for retrieval of every accession in the batch")
@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import contextlib
+import math
+import os
+import time
+from typing import Optional
+
+
+class AdmissionRejected(Exception):
+    '''
+    `retry_after` is None when retrying can't help, because the request is larger than the limits allow at all.
+    '''
+
+    def __init__(self, reason: str, retry_after: Optional[int]):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    '''
+    A place in the queue; `waiter` resolves once the ticket has been given a slot.
+    '''
+
+    def __init__(self, submitter_id: str, waiter: asyncio.Future):
+        self.submitter_id = submitter_id
+        self.waiter = waiter
+        self.enqueued = time.monotonic()
+
+
+class AdmissionController:
+    '''
+    Limits how many pipeline runs execute at once and shares the free slots fairly between submitters.
+
+    Waiting runs are queued per submitter and each free slot goes to the waiting submitter with the fewest running jobs, ties going to
+    whoever was served least recently, so one submitter with many queued runs can't starve the others. A submitter never holds more
+    than `max_running_per_submitter` slots, and a new run is rejected when the submitter already has `max_queued_per_submitter` runs
+    admitted or waiting, or when `max_queue_depth` runs are waiting in total.
+    '''
+
+    def __init__(self, max_running: int = 4, max_running_per_submitter: int = 2, max_queued_per_submitter: int = 50, max_queue_depth: int = 100,
+                 default_job_seconds: float = 600.0):
+        self.max_running = max_running
+        self.max_running_per_submitter = max_running_per_submitter
+        self.max_queued_per_submitter = max_queued_per_submitter
+        self.max_queue_depth = max_queue_depth
+        self._running = collections.Counter()
+        self._queues = collections.defaultdict(collections.deque)
+        self._last_served = {}
+        self._served = 0
+        self._wait_seconds = collections.deque(maxlen=100)
+        self._job_seconds = collections.deque(maxlen=100)
+        self._default_job_seconds = default_job_seconds
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def check(self, submitter_id: str, count: int = 1):
+        '''
+        Raises AdmissionRejected if `count` more runs for `submitter_id` would exceed the submitter's quota or the queue depth.
+        '''
+        if count > self.max_queued_per_submitter or count - self.max_running > self.max_queue_depth:
+            raise AdmissionRejected(f"{count} downloads is more than can ever be queued at once, the limit is {self.max_batch_size}", None)
+        if self._running[submitter_id] + len(self._queues.get(submitter_id, ())) + count > self.max_queued_per_submitter:
+            raise AdmissionRejected(f"submitter {submitter_id} can have at most {self.max_queued_per_submitter} downloads running or queued", self.retry_after())
+        if self.queued + count - max(0, self.max_running - self.running) > self.max_queue_depth:
+            raise AdmissionRejected(f"download queue is full ({self.max_queue_depth} waiting)", self.retry_after())
+
+    @property
+    def max_batch_size(self) -> int:
+        return min(self.max_queued_per_submitter, self.max_queue_depth + self.max_running)
+
+    def request(self, submitter_id: str, enforce_quota: bool = True) -> AdmissionTicket:
+        '''
+        Queues a run for `submitter_id` right away, without waiting; pass the ticket to `slot` to wait for and hold the slot.
+        Raises AdmissionRejected if the run would exceed a quota; `enforce_quota=False` skips those checks for runs that were
+        already accepted, e.g. the items of a batch.
+        '''
+        if enforce_quota:
+            self.check(submitter_id)
+        ticket = AdmissionTicket(submitter_id, asyncio.get_running_loop().create_future())
+        self._queues[submitter_id].append(ticket.waiter)
+        self._dispatch()
+        return ticket
+
+    @contextlib.asynccontextmanager
+    async def slot(self, submitter_id: str = None, enforce_quota: bool = True, ticket: AdmissionTicket = None):
+        '''
+        Holds one pipeline slot for the duration of the block, waiting in the fair queue if necessary, either for a ticket from
+        `request` or for a new request made for `submitter_id`.
+        '''
+        if ticket is None:
+            ticket = self.request(submitter_id, enforce_quota=enforce_quota)
+        try:
+            await ticket.waiter
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+        started = time.monotonic()
+        self._wait_seconds.append(started - ticket.enqueued)
+        try:
+            yield
+        finally:
+            self._job_seconds.append(time.monotonic() - started)
+            self._release(ticket.submitter_id)
+
+    def cancel(self, ticket: AdmissionTicket):
+        '''
+        Gives up a ticket that won't be used, freeing its slot if it was already given one.
+        '''
+        if ticket.waiter.done() and not ticket.waiter.cancelled():
+            self._release(ticket.submitter_id)
+        else:
+            ticket.waiter.cancel()
+            self._discard(ticket.submitter_id, ticket.waiter)
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        '''
+        How many of the submitter's runs are queued ahead of the ticket, counting the ticket itself; 0 once it has a slot.
+        '''
+        queue = self._queues.get(ticket.submitter_id, ())
+        return queue.index(ticket.waiter) + 1 if ticket.waiter in queue else 0
+
+    def retry_after(self) -> int:
+        '''
+        Seconds until a slot is likely to free up, estimated from recent job durations and the current queue.
+        '''
+        job_seconds = sum(self._job_seconds) / len(self._job_seconds) if len(self._job_seconds) > 0 else self._default_job_seconds
+        return max(1, math.ceil(job_seconds * (self.queued + 1) / self.max_running))
+
+    def stats(self) -> dict:
+        submitters = {submitter_id: {"running": self._running[submitter_id], "queued": len(self._queues.get(submitter_id, ()))}
+                      for submitter_id in set(self._running) | set(self._queues)}
+        wait_seconds = list(self._wait_seconds)
+        return {"running": self.running, "queued": self.queued, "max_running": self.max_running,
+                "max_running_per_submitter": self.max_running_per_submitter, "max_queued_per_submitter": self.max_queued_per_submitter,
+                "max_queue_depth": self.max_queue_depth, "submitters": submitters,
+                "wait_seconds": {"count": len(wait_seconds), "mean": sum(wait_seconds) / len(wait_seconds) if len(wait_seconds) > 0 else 0.0,
+                                 "max": max(wait_seconds, default=0.0)}}
+
+    def _dispatch(self):
+        while self.running < self.max_running:
+            eligible = [submitter_id for submitter_id in self._queues if self._running[submitter_id] < self.max_running_per_submitter]
+            if len(eligible) == 0:
+                return
+            submitter_id = min(eligible, key=lambda s: (self._running[s], self._last_served.get(s, -1)))
+            queue = self._queues[submitter_id]
+            waiter = queue.popleft()
+            if len(queue) == 0:
+                del self._queues[submitter_id]
+            if waiter.cancelled():
+                # cancelled while queued, before its owner could discard it
+                continue
+            self._running[submitter_id] += 1
+            self._served += 1
+            self._last_served[submitter_id] = self._served
+            waiter.set_result(None)
+
+    def _discard(self, submitter_id: str, waiter):
+        queue = self._queues.get(submitter_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if len(queue) == 0:
+                del self._queues[submitter_id]
+
+    def _release(self, submitter_id: str):
+        self._running[submitter_id] -= 1
+        if self._running[submitter_id] <= 0:
+            del self._running[submitter_id]
+            if submitter_id not in self._queues:
+                self._last_served.pop(submitter_id, None)
+        self._dispatch()
+
+
+def admission_controller_from_env() -> AdmissionController:
+    return AdmissionController(max_running=int(os.getenv("ADMISSION_MAX_RUNNING", "4")),
+                               max_running_per_submitter=int(os.getenv("ADMISSION_MAX_RUNNING_PER_SUBMITTER", "2")),
+                               max_queued_per_submitter=int(os.getenv("ADMISSION_MAX_QUEUED_PER_SUBMITTER", "50")),
+                               max_queue_depth=int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "100")))
@@ -0,0 +1,38 @@
+import datetime
+
+BATCH_ITEM_STATUSES = ["queued", "running", "finished", "failed", "existing"]
+UNFINISHED_BATCH_ITEM_STATUSES = ["queued", "running"]
+
+
+def parse_accession_ids(accession_ids: str) -> list:
+    '''
+    Splits a comma-separated list of accession ids, dropping blanks and repeats but keeping the order they were given in.
+    '''
+    parsed = []
+    for accession_id in accession_ids.split(","):
+        accession_id = accession_id.strip()
+        if accession_id != "" and accession_id not in parsed:
+            parsed.append(accession_id)
+    return parsed
+
+
+def batch_items(accession_ids: list, existing: dict, now: datetime.datetime) -> list:
+    '''
+    One item per accession id; those already downloaded, per `existing` (accession_id -> immunespace_download_id), are `existing`
+    and won't be downloaded again, the rest start out `queued`.
+    '''
+    return [{"accession_id": accession_id, "status": "existing" if accession_id in existing else "queued", "immunespace_download_id": existing.get(accession_id),
+             "error": None, "date_started": None, "date_finished": now if accession_id in existing else None} for accession_id in accession_ids]
+
+
+def batch_status(batch: dict) -> dict:
+    counts = {status: 0 for status in BATCH_ITEM_STATUSES}
+    for item in batch["items"]:
+        counts[item["status"]] += 1
+    if sum(counts[status] for status in UNFINISHED_BATCH_ITEM_STATUSES) > 0:
+        status = "running"
+    elif counts["failed"] > 0:
+        status = "failed" if counts["failed"] == len(batch["items"]) else "partial"
+    else:
+        status = "finished"
+    return dict(batch, status=status, counts=counts)
@@ -0,0 +1,13 @@
+def utf8_tail(text: str, max_bytes: int):
+    '''
+    Returns the longest tail of `text` whose utf8 encoding fits in `max_bytes`, and whether anything was cut off.
+    '''
+    encoded = text.encode("utf8")
+    if len(encoded) <= max_bytes:
+        return text, False
+    tail = encoded[len(encoded) - max_bytes:]
+    # skip continuation bytes (0b10xxxxxx) so the tail starts on a character boundary
+    start = 0
+    while start < len(tail) and tail[start] & 0xC0 == 0x80:
+        start += 1
+    return tail[start:].decode("utf8"), True
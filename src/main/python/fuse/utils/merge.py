@@ -0,0 +1,115 @@
+import csv
+from typing import Optional
+
+import numpy
+
+NA_VALUES = {"", "NA", "NaN", "nan", "null"}
+
+
+class RunMatrix:
+    def __init__(self, run_id: str, genes: list, samples: list, values, batch: Optional[str] = None):
+        self.run_id = run_id
+        self.batch = batch if batch is not None else run_id
+        self.genes = list(genes)
+        self.samples = list(samples)
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+        if self.values.shape != (len(self.genes), len(self.samples)):
+            raise ValueError(f"run {run_id}: values are {self.values.shape}, expected {len(self.genes)}x{len(self.samples)}")
+
+
+class MergedMatrix:
+    '''
+    One gene x sample matrix across runs; `sample_runs[i]` is the (sample, run_id, batch) of column i.
+    Genes missing from a run are NaN in that run's columns.
+    '''
+
+    def __init__(self, genes: list, samples: list, values: numpy.ndarray, sample_runs: list):
+        self.genes = genes
+        self.samples = samples
+        self.values = values
+        self.sample_runs = sample_runs
+
+
+def _merged_genes(run_genes: list) -> numpy.ndarray:
+    # sorted union of every run's genes; each run's rows are then found by binary search
+    if len(run_genes) == 0:
+        return numpy.array([], dtype=str)
+    return numpy.unique(numpy.concatenate([numpy.asarray(genes, dtype=str) for genes in run_genes]))
+
+
+def _gene_rows(run_id: str, merged_genes: numpy.ndarray, genes: list) -> numpy.ndarray:
+    if len(set(genes)) != len(genes):
+        raise ValueError(f"run {run_id} has duplicate genes, aggregate them before merging")
+    return numpy.searchsorted(merged_genes, numpy.asarray(genes, dtype=str))
+
+
+def merge_run_matrices(runs: list) -> MergedMatrix:
+    '''
+    Outer-joins RunMatrix objects on their genes into one preallocated matrix, placing each run's block with a single fancy-indexed
+    assignment instead of building intermediate frames.
+    '''
+    merged_genes = _merged_genes([run.genes for run in runs])
+    number_of_samples = sum(len(run.samples) for run in runs)
+    values = numpy.full((len(merged_genes), number_of_samples), numpy.nan, dtype=numpy.float64)
+    samples = []
+    sample_runs = []
+    column = 0
+    for run in runs:
+        rows = _gene_rows(run.run_id, merged_genes, run.genes)
+        values[rows, column:column + len(run.samples)] = run.values
+        column += len(run.samples)
+        samples.extend(run.samples)
+        sample_runs.extend((sample, run.run_id, run.batch) for sample in run.samples)
+    return MergedMatrix(genes=merged_genes.tolist(), samples=samples, values=values, sample_runs=sample_runs)
+
+
+def merge_run_matrix_files(run_files: list) -> MergedMatrix:
+    '''
+    Same as merge_run_matrices, for per-run CSV files with a header row of sample ids and the gene in the first column.
+    `run_files` is a list of (run_id, batch, path).
+
+    The files are read twice: once for just the gene and sample ids, to size the output, and once to stream each row straight into
+    its place, so memory stays at the size of the merged matrix.
+    '''
+    run_genes = []
+    run_samples = []
+    for (run_id, batch, path) in run_files:
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            run_samples.append(next(reader)[1:])
+            run_genes.append([row[0] for row in reader if len(row) > 0])
+    merged_genes = _merged_genes(run_genes)
+    values = numpy.full((len(merged_genes), sum(len(samples) for samples in run_samples)), numpy.nan, dtype=numpy.float64)
+
+    samples = []
+    sample_runs = []
+    column = 0
+    for ((run_id, batch, path), genes, samples_of_run) in zip(run_files, run_genes, run_samples):
+        rows = _gene_rows(run_id, merged_genes, genes)
+        number_of_columns = len(samples_of_run)
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for (row, line) in zip(rows, (line for line in reader if len(line) > 0)):
+                if len(line) - 1 != number_of_columns:
+                    raise ValueError(f"run {run_id}: gene {line[0]} has {len(line) - 1} values, expected {number_of_columns}")
+                values[row, column:column + number_of_columns] = [numpy.nan if value in NA_VALUES else float(value) for value in line[1:]]
+        column += number_of_columns
+        samples.extend(samples_of_run)
+        sample_runs.extend((sample, run_id, batch if batch is not None else run_id) for sample in samples_of_run)
+    return MergedMatrix(genes=merged_genes.tolist(), samples=samples, values=values, sample_runs=sample_runs)
+
+
+def write_merged_matrix(merged: MergedMatrix, matrix_path: str, mapping_path: str, gene_column: str = "gene", float_format: str = "{:.10f}"):
+    '''
+    Writes the merged matrix as a gene x sample CSV, missing values as NA, and the column to run/batch mapping as a second CSV.
+    '''
+    with open(matrix_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([gene_column] + merged.samples)
+        for (gene, row) in zip(merged.genes, merged.values):
+            writer.writerow([gene] + ["NA" if numpy.isnan(value) else float_format.format(value) for value in row])
+    with open(mapping_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sample", "run_id", "batch"])
+        writer.writerows(merged.sample_runs)
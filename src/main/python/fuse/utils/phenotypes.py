@@ -0,0 +1,48 @@
+import csv
+import math
+from typing import Iterable, Optional
+
+# columns written by txscience/tx-immunespace-groups to phenoDataMatrix.csv
+INDEXED_FIELDS = ["cohort", "study_time_collected", "biosample_accession"]
+
+
+def _coerce(value: str):
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    if not math.isfinite(number):
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def read_phenotype_rows(lines: Iterable[str]):
+    '''
+    Yields one dict per phenoDataMatrix.csv row, keyed by the header; `study_time_collected` is stored as a number so it can be range-queried.
+    '''
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    # Mongo field names can't contain '.' or start with '$'
+    header = [column.strip().replace(".", "_").lstrip("$") for column in header]
+    for values in reader:
+        if len(values) == 0:
+            continue
+        row = dict(zip(header, values))
+        if "study_time_collected" in row:
+            row["study_time_collected"] = _coerce(row["study_time_collected"])
+        yield row
+
+
+def phenotype_query(object_id: str, cohort: Optional[list] = None, study_time_collected: Optional[list] = None,
+                    biosample_accession: Optional[list] = None, participant_id: Optional[list] = None) -> dict:
+    query = {"object_id": object_id}
+    for (field, values) in [("cohort", cohort), ("study_time_collected", study_time_collected),
+                            ("biosample_accession", biosample_accession), ("participant_id", participant_id)]:
+        if values is None or len(values) == 0:
+            continue
+        if field == "study_time_collected":
+            values = [_coerce(value) for value in values]
+        query[field] = values[0] if len(values) == 1 else {"$in": values}
+    return query
@@ -0,0 +1,119 @@
+import asyncio
+import codecs
+import datetime
+import json
+import threading
+from typing import Optional
+
+TERMINAL_EVENTS = ("finished", "failed")
+
+
+class ProgressBroker:
+    '''
+    In-memory fan-out of progress events per job.
+
+    Events are published from worker threads and delivered to any number of asyncio subscribers; each subscriber first
+    replays the job's history, so late joiners see the whole job without anyone polling the database.
+    '''
+
+    def __init__(self, max_history: int = 1000, retain_finished_jobs: int = 100):
+        self.max_history = max_history
+        self.retain_finished_jobs = retain_finished_jobs
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._finished = []
+
+    def start(self, job_id: str, **info):
+        with self._lock:
+            # a rerun reuses the job id; its earlier run must not count towards retention, or it would evict the live one
+            if job_id in self._finished:
+                self._finished.remove(job_id)
+            self._jobs[job_id] = {"info": dict(info, job_id=job_id), "history": [], "subscribers": set(), "done": False}
+        self.publish(job_id, "started", **info)
+
+    def jobs(self, include_finished: bool = False) -> list:
+        with self._lock:
+            return [dict(job["info"], done=job["done"]) for job in self._jobs.values() if include_finished or not job["done"]]
+
+    def publish(self, job_id: str, event: str, **fields):
+        message = dict(fields, job_id=job_id, event=event, timestamp=datetime.datetime.utcnow().isoformat())
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["done"]:
+                return
+            job["history"].append(message)
+            if len(job["history"]) > self.max_history:
+                # keep the lifecycle events, drop the oldest log lines
+                for idx, old in enumerate(job["history"]):
+                    if old["event"] == "log":
+                        del job["history"][idx]
+                        break
+            if event in TERMINAL_EVENTS:
+                job["done"] = True
+                self._finished.append(job_id)
+                while len(self._finished) > self.retain_finished_jobs:
+                    self._jobs.pop(self._finished.pop(0), None)
+            subscribers = list(job["subscribers"])
+        for (loop, queue) in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    async def subscribe(self, job_id: str):
+        '''
+        Yields the job's history followed by live events, returning after a terminal event.
+        '''
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        subscriber = (loop, queue)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            history = list(job["history"])
+            done = job["done"]
+            if not done:
+                job["subscribers"].add(subscriber)
+        try:
+            for message in history:
+                yield message
+            if done:
+                return
+            while True:
+                message = await queue.get()
+                yield message
+                if message["event"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job["subscribers"].discard(subscriber)
+
+    def exists(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._jobs
+
+
+class LogLineDecoder:
+    '''
+    Incrementally decodes a byte stream into complete utf8 lines, tolerating chunks that split characters or lines.
+    '''
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self._buffer = ""
+
+    def feed(self, chunk: bytes) -> list:
+        self._buffer += self._decoder.decode(chunk)
+        *lines, self._buffer = self._buffer.split("\n")
+        return lines
+
+    def flush(self) -> list:
+        self._buffer += self._decoder.decode(b"", final=True)
+        lines = [self._buffer] if self._buffer else []
+        self._buffer = ""
+        return lines
+
+
+def sse_format(message: dict, event: Optional[str] = None) -> str:
+    event = event or message.get("event")
+    return f"event: {event}\ndata: {json.dumps(message, default=str)}\n\n"
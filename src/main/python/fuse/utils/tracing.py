@@ -0,0 +1,154 @@
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Optional
+
+logger = logging.getLogger("fuse-provider-immunespace")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, trace_id: str, name: str, parent_id: Optional[str] = None, attributes: Optional[dict] = None):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error = None
+        self.start_time = datetime.datetime.utcnow()
+        self.end_time = None
+        self._start = time.perf_counter()
+        self.duration_seconds = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.end_time = datetime.datetime.utcnow()
+        self.duration_seconds = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start_time": self.start_time.isoformat(), "end_time": self.end_time.isoformat() if self.end_time is not None else None,
+                "duration_seconds": self.duration_seconds, "status": self.status, "error": self.error, "attributes": self.attributes}
+
+
+class SpanExporter:
+    '''
+    Receives every span of a finished trace in one call, root span last.
+    '''
+
+    def export(self, spans: list):
+        raise NotImplementedError
+
+
+class NoopSpanExporter(SpanExporter):
+    def export(self, spans: list):
+        pass
+
+
+class ConsoleSpanExporter(SpanExporter):
+    def export(self, spans: list):
+        for span in spans:
+            logger.info(f"span: {json.dumps(span.to_dict(), default=str)}")
+
+
+class FileSpanExporter(SpanExporter):
+    '''
+    Appends one JSON document per span to a local file.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: list):
+        lines = "".join(f"{json.dumps(span.to_dict(), default=str)}\n" for span in spans)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+
+class Tracer:
+    '''
+    Collects nested spans per trace and hands a finished trace to the exporter when its root span closes.
+
+    A trace is kept if it took at least `slow_threshold_seconds`, failed, or was picked by `sample_rate`; all other traces are dropped.
+    '''
+
+    def __init__(self, exporter: SpanExporter, sample_rate: float = 1.0, slow_threshold_seconds: Optional[float] = None):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold_seconds = slow_threshold_seconds
+        self._lock = threading.Lock()
+        self._traces = {}
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        span = Span(trace_id=trace_id, name=name, parent_id=parent.span_id if parent is not None else None, attributes=attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.finish()
+            _current_span.reset(token)
+            self._record(span, is_root=parent is None)
+
+    def _record(self, span: Span, is_root: bool):
+        with self._lock:
+            spans = self._traces.setdefault(span.trace_id, [])
+            spans.append(span)
+            if not is_root:
+                return
+            del self._traces[span.trace_id]
+        if self._keep(span):
+            try:
+                self.exporter.export(spans)
+            except Exception as e:
+                logger.warning(f"failed to export trace {span.trace_id}: {e}")
+
+    def _keep(self, root: Span) -> bool:
+        if root.status == "error":
+            return True
+        if self.slow_threshold_seconds is not None and root.duration_seconds >= self.slow_threshold_seconds:
+            return True
+        return random.random() < self.sample_rate
+
+
+def tracer_from_env() -> Tracer:
+    '''
+    TRACE_EXPORTER is one of "console" (default), "file" or "none"; "file" writes to TRACE_FILE.
+    '''
+    exporter_name = os.getenv("TRACE_EXPORTER", "console").lower()
+    if exporter_name == "file":
+        exporter = FileSpanExporter(os.getenv("TRACE_FILE", "/app/data/traces.jsonl"))
+    elif exporter_name == "none":
+        exporter = NoopSpanExporter()
+    else:
+        exporter = ConsoleSpanExporter()
+    slow_threshold_seconds = os.getenv("TRACE_SLOW_THRESHOLD_SECONDS")
+    return Tracer(exporter=exporter,
+                  sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "1.0")),
+                  slow_threshold_seconds=float(slow_threshold_seconds) if slow_threshold_seconds else None)
@@ -1,22 +1,30 @@
+import asyncio
 import datetime
 import json
 import logging
 import os
 import pathlib
 import shutil
+import time
 import traceback
 import uuid
 from logging.config import dictConfig
 
 import docker
 import pymongo
-from fastapi import FastAPI, Depends, Path, Query, HTTPException
+from fastapi import FastAPI, Depends, Path, Query, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fuse_cdm.main import ProviderParameters, FileType, DataType, Contents, Passports
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import StreamingResponse
 
-# https://developer.mozilla.org/en-US/docs/Web/API/WritableStream
-from fuse.models.Objects import ProviderResponse
+from fuse.models.Objects import ProviderResponse, BatchProviderParameters
+from fuse.utils.admission import AdmissionRejected, admission_controller_from_env
+from fuse.utils.batches import UNFINISHED_BATCH_ITEM_STATUSES, parse_accession_ids, batch_items, batch_status
+from fuse.utils.logs import utf8_tail
+from fuse.utils.phenotypes import INDEXED_FIELDS, read_phenotype_rows, phenotype_query
+from fuse.utils.progress import ProgressBroker, LogLineDecoder, sse_format
+from fuse.utils.tracing import tracer_from_env
 
 LOGGING = {
     'version': 1,
@@ -80,9 +88,51 @@ mongo_database_connection_url = f"mongodb://{mongo_user_name}:{mongo_password}@i
 mongo_client = pymongo.MongoClient(mongo_database_connection_url)
 mongo_db = mongo_client[mongo_database_name]
 mongo_db_immunespace_downloads_column = mongo_db["immunespace_downloads"]
+mongo_db_immunespace_download_logs_column = mongo_db["immunespace_download_logs"]
+mongo_db_immunespace_download_batches_column = mongo_db["immunespace_download_batches"]
+mongo_db_immunespace_phenotypes_column = mongo_db["immunespace_phenotypes"]
+
+# Mongo caps documents at 16MB; keep the last 8MB of utf8 encoded output, that's where the errors are
+max_stderr_bytes = 8 * 1024 * 1024
 
 docker_client = docker.from_env()
 
+tracer = tracer_from_env()
+
+progress_broker = ProgressBroker()
+
+admission_controller = admission_controller_from_env()
+
+# downloads currently running, keyed by (submitter_id, accession_id, apikey), so duplicate requests share one pipeline run
+in_flight_downloads = {}
+# phenotype backfills currently running, keyed by the properties object_id, so concurrent first queries share one load
+in_flight_phenotype_loads = {}
+
+# keeps references to scheduled batch items so they aren't garbage collected mid-run
+background_tasks = set()
+
+
+@app.on_event("startup")
+def fail_interrupted_batch_items():
+    # batch items only run as tasks of this process; anything left unfinished by a previous one will never complete
+    unfinished = {"item.status": {"$in": UNFINISHED_BATCH_ITEM_STATUSES}}
+    update = {"$set": {"items.$[item].status": "failed", "items.$[item].error": "interrupted by a service restart, please resubmit",
+                       "items.$[item].date_finished": datetime.datetime.utcnow()}}
+    ret = mongo_db_immunespace_download_batches_column.update_many({"items.status": {"$in": UNFINISHED_BATCH_ITEM_STATUSES}}, update, array_filters=[unfinished])
+    if ret.modified_count > 0:
+        logger.info(f"marked unfinished items of {ret.modified_count} batches as failed")
+
+
+@app.on_event("startup")
+def create_indexes():
+    mongo_db_immunespace_downloads_column.create_index("object_id")
+    mongo_db_immunespace_downloads_column.create_index([("submitter_id", pymongo.ASCENDING), ("accession_id", pymongo.ASCENDING)])
+    mongo_db_immunespace_download_logs_column.create_index("immunespace_download_id", unique=True)
+    mongo_db_immunespace_download_batches_column.create_index("batch_id", unique=True)
+    for field in INDEXED_FIELDS:
+        mongo_db_immunespace_phenotypes_column.create_index([("object_id", pymongo.ASCENDING), (field, pymongo.ASCENDING)])
+    mongo_db_immunespace_phenotypes_column.create_index("immunespace_download_id")
+
 
 @app.get("/service-info", summary="Retrieve information about this service")
 async def service_info():
@@ -122,7 +172,7 @@ async def objects(object_id: str = Path(default="", description="DrsObject ident
                   expand: bool = Query(default=False,
                                        description="If false and the object_id refers to a bundle, then the ContentsObject array contains only those objects directly contained in the bundle. That is, if the bundle contains other bundles, those other bundles are not recursively included in the result. If true and the object_id refers to a bundle, then the entire set of objects in the bundle is expanded. That is, if the bundle contains aother bundles, then those other bundles are recursively expanded and included in the result. Recursion continues through the entire sub-tree of the bundle. If the object_id refers to a blob, then the query parameter is ignored.")):
     projection = {"_id": 0, "immunespace_download_id": 1, "object_id": 1, "submitter_id": 1, "accession_id": 1, "apikey": 1, "status": 1, "data_type": 1,
-                  "file_type": 1, "file_name": 1, "size": 1, "dimension": 1, "stderr": 1, "date_downloaded": 1}
+                  "file_type": 1, "file_name": 1, "size": 1, "dimension": 1, "date_downloaded": 1}
     query = {"object_id": object_id}
     found_immunespace_download = mongo_db_immunespace_downloads_column.find_one(query, projection)
     if found_immunespace_download is not None:
@@ -142,7 +192,7 @@ async def objects(object_id: str = Path(default="", description="DrsObject ident
                                created_time=f"{found_immunespace_download['date_downloaded']}",
                                mime_type="application/csv",
                                status="finished",
-                               contents=[contents], stderr=found_immunespace_download['stderr'])
+                               contents=[contents])
 
         return vars(ret)
     else:
@@ -222,105 +272,439 @@ async def search(submitter_id: str):
 
 
 @app.post("/submit")
-async def submit(parameters: ProviderParameters = Depends(ProviderParameters.as_form)):
+async def submit(response: Response, parameters: ProviderParameters = Depends(ProviderParameters.as_form)):
     logger.info(f"parameters: {parameters}")
-    try:
+    with tracer.span("submit", submitter_id=parameters.submitter_id, accession_id=parameters.accession_id, file_type=parameters.file_type) as submit_span:
+        response.headers["X-Trace-Id"] = submit_span.trace_id
+        try:
+
+            immunespace_download_id = await ensure_immunespace_download(submitter_id=parameters.submitter_id, accession_id=parameters.accession_id,
+                                                                        apikey=parameters.apikey)
+            submit_span.set_attribute("immunespace_download_id", immunespace_download_id)
+
+            immunespace_download_query = {"submitter_id": parameters.submitter_id, "accession_id": parameters.accession_id,
+                                          "apikey": parameters.apikey, "file_type": parameters.file_type}
+
+            projection = {"_id": 0, "immunespace_download_id": 1, "object_id": 1, "submitter_id": 1, "accession_id": 1, "apikey": 1, "status": 1, "data_type": 1,
+                          "file_type": 1, "file_name": 1, "size": 1, "dimension": 1, "date_downloaded": 1}
+            with tracer.span("mongo.find_one", collection="immunespace_downloads"):
+                found_immunespace_download = mongo_db_immunespace_downloads_column.find_one(immunespace_download_query, projection)
+
+            # contents = Contents(id=found_immunespace_download["object_id"], name=found_immunespace_download["file_name"],
+            # drs_uri=f"http://localhost:{os.getenv('API_PORT')}/files/{found_immunespace_download['object_id']}")
+
+            ret = ProviderResponse(id=found_immunespace_download["object_id"],
+                                   object_id=found_immunespace_download["object_id"],
+                                   submitter_id=found_immunespace_download["submitter_id"],
+                                   size=found_immunespace_download["size"],
+                                   dimension=found_immunespace_download["dimension"],
+                                   name=found_immunespace_download['file_name'],
+                                   self_uri=f"http://localhost:{os.getenv('API_PORT')}/objects/{found_immunespace_download['object_id']}",
+                                   data_type=found_immunespace_download["data_type"],
+                                   file_type=found_immunespace_download["file_type"],
+                                   created_time=f"{found_immunespace_download['date_downloaded']}",
+                                   mime_type="application/csv", status="finished",
+                                   contents=[])
+
+            return vars(ret)
+
+        except AdmissionRejected as e:
+            logger.info(f"rejected submit from {parameters.submitter_id}: {e.reason}")
+            submit_span.set_attribute("rejected", e.reason)
+            raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+        except Exception as e:
+            logger.exception(e)
+            submit_span.status = "error"
+            submit_span.error = f"{type(e).__name__}: {e}"
+            return HTTPException(status_code=404, detail="Not found")
+
 
-        immunespace_download_query = {"submitter_id": parameters.submitter_id, "accession_id": parameters.accession_id,
-                                      "apikey": parameters.apikey, "file_type": parameters.file_type}
+async def ensure_immunespace_download(submitter_id: str, accession_id: str, apikey: str, enforce_quota: bool = True, on_admitted=None):
+    '''
+    Returns the immunespace_download_id for the accession, running the download pipeline first if it hasn't been downloaded yet.
+    One run produces every file type, so concurrent requests for the same accession, whatever file they ask for, wait on the one
+    download already in flight instead of starting another; their span gets the `joined_trace_id` of the request that started it,
+    whose trace holds the pipeline's spans.
+    Pipeline runs go through the admission controller: the request that starts a run is checked against the submitter's quota
+    and raises AdmissionRejected, requests that join a run already in flight are never rejected. The run's progress is published
+    from the moment it is queued. `on_admitted(immunespace_download_id)` is called once the run this request waits on has been
+    given a slot, or right away if nothing needs to run.
+    '''
+    key = (submitter_id, accession_id, apikey)
+    if key not in in_flight_downloads:
+        immunespace_download_query = {"submitter_id": submitter_id, "accession_id": accession_id, "apikey": apikey, "file_type": FileType.datasetGeneExpression}
         projection = {"_id": 0, "immunespace_download_id": 1, "object_id": 1, "file_type": 1}
-        found_immunespace_download = mongo_db_immunespace_downloads_column.find_one(immunespace_download_query, projection)
+        with tracer.span("mongo.find_one", collection="immunespace_downloads") as span:
+            found_immunespace_download = mongo_db_immunespace_downloads_column.find_one(immunespace_download_query, projection)
+            span.set_attribute("found", found_immunespace_download is not None)
         if found_immunespace_download is not None:
             logger.info(f"found_immunespace_download: {found_immunespace_download}")
             immunespace_download_id = found_immunespace_download["immunespace_download_id"]
             local_path = os.path.abspath(f"/app/data/{immunespace_download_id}")
             logger.debug(f"local_path: {local_path}")
-            if os.path.exists(local_path) and len(os.listdir(local_path)) == 0:
-                logger.debug(f"path exists, but is empty")
-                run_immunespace_download(immunespace_download_id=immunespace_download_id, accession_id=parameters.accession_id, apikey=parameters.apikey)
+            if not (os.path.exists(local_path) and len(os.listdir(local_path)) == 0):
+                if on_admitted is not None:
+                    on_admitted(immunespace_download_id)
+                return immunespace_download_id
+            logger.debug(f"path exists, but is empty")
         else:
             immunespace_download_id = str(uuid.uuid4())[:8]
-            local_path = os.path.join(f"/app/data/{immunespace_download_id}")
-            logger.info(f"local_path: {local_path}")
+        # queue for a slot before the run is shared, so a rejection only reaches the request that started it
+        ticket = admission_controller.request(submitter_id, enforce_quota=enforce_quota)
+        progress_broker.start(immunespace_download_id, submitter_id=submitter_id, accession_id=accession_id)
+        progress_broker.publish(immunespace_download_id, "queued", position=admission_controller.position(ticket),
+                                estimated_wait_seconds=admission_controller.retry_after() if not ticket.waiter.done() else 0)
+        in_flight = asyncio.ensure_future(run_and_record_immunespace_download(immunespace_download_id=immunespace_download_id, submitter_id=submitter_id,
+                                                                              accession_id=accession_id, apikey=apikey,
+                                                                              record=found_immunespace_download is None, ticket=ticket))
+        owner_span = tracer.current_span()
+        in_flight_downloads[key] = {"future": in_flight, "ticket": ticket, "immunespace_download_id": immunespace_download_id,
+                                    "trace_id": owner_span.trace_id if owner_span is not None else None}
+        in_flight.add_done_callback(lambda _: in_flight_downloads.pop(key, None))
+    elif tracer.current_span() is not None:
+        # the pipeline's spans belong to the trace of the request that started the run; point this trace at it
+        tracer.current_span().set_attribute("joined_trace_id", in_flight_downloads[key]["trace_id"])
+    in_flight = in_flight_downloads[key]["future"]
+    ticket = in_flight_downloads[key]["ticket"]
+    if on_admitted is not None:
+        immunespace_download_id = in_flight_downloads[key]["immunespace_download_id"]
+        ticket.waiter.add_done_callback(lambda waiter: on_admitted(immunespace_download_id) if not waiter.cancelled() else None)
+    return await asyncio.shield(in_flight)
+
+
+async def run_and_record_immunespace_download(immunespace_download_id: str, submitter_id: str, accession_id: str, apikey: str, record: bool, ticket):
+    local_path = os.path.join(f"/app/data/{immunespace_download_id}")
+    logger.info(f"local_path: {local_path}")
+    admission_requested = time.monotonic()
+    try:
+        async with admission_controller.slot(ticket=ticket):
+            admission_wait_seconds = time.monotonic() - admission_requested
+            if tracer.current_span() is not None:
+                tracer.current_span().set_attribute("admission_wait_seconds", admission_wait_seconds)
+            progress_broker.publish(immunespace_download_id, "admitted", wait_seconds=admission_wait_seconds)
             os.makedirs(local_path, exist_ok=True)
-            stderr = run_immunespace_download(immunespace_download_id=immunespace_download_id, accession_id=parameters.accession_id, apikey=parameters.apikey)
-            for (file_type, file_name) in [(FileType.datasetGeneExpression, "geneBySampleMatrix.csv"), (FileType.datasetProperties, "phenoDataMatrix.csv")]:
-                file_path = os.path.join(local_path, file_name)
-                with open(file_path) as f:
-                    number_of_columns = len(f.readline().rstrip().split(sep=",")) - 1
-                f.close()
+            stderr = await run_in_threadpool(run_immunespace_download, immunespace_download_id=immunespace_download_id, accession_id=accession_id, apikey=apikey)
+            if record:
+                await run_in_threadpool(record_immunespace_download, immunespace_download_id=immunespace_download_id, submitter_id=submitter_id,
+                                        accession_id=accession_id, apikey=apikey, stderr=stderr)
+            else:
+                save_immunespace_download_log(immunespace_download_id, stderr)
+    except BaseException as e:
+        # also reached if the run is cancelled while queued, so subscribers always see the run end
+        progress_broker.publish(immunespace_download_id, "failed", error=f"{e}" or type(e).__name__)
+        raise
+    progress_broker.publish(immunespace_download_id, "finished")
+    return immunespace_download_id
+
+
+def record_immunespace_download(immunespace_download_id: str, submitter_id: str, accession_id: str, apikey: str, stderr: str):
+    local_path = os.path.join(f"/app/data/{immunespace_download_id}")
+    progress_broker.publish(immunespace_download_id, "stage_started", stage="ingest")
+    save_immunespace_download_log(immunespace_download_id, stderr)
+    immunespace_download_entries = []
+    for (file_type, file_name) in [(FileType.datasetGeneExpression, "geneBySampleMatrix.csv"), (FileType.datasetProperties, "phenoDataMatrix.csv")]:
+        file_path = os.path.join(local_path, file_name)
+        with tracer.span("file.stat", file_name=file_name) as span:
+            with open(file_path) as f:
+                number_of_columns = len(f.readline().rstrip().split(sep=",")) - 1
+            f.close()
+
+            with open(file_path) as f:
+                number_of_rows = len(f.readlines())
+            f.close()
+
+            size = os.path.getsize(file_path)
+            dimension = f"{number_of_rows}x{number_of_columns}"
+            span.set_attributes(bytes=size, rows=number_of_rows, columns=number_of_columns)
+
+        immunespace_download_entry = {"immunespace_download_id": immunespace_download_id, "submitter_id": submitter_id,
+                                      "data_type": DataType.geneExpression, "object_id": str(uuid.uuid4()), "accession_id": accession_id,
+                                      "apikey": apikey, "file_type": file_type, "file_name": file_name,
+                                      "date_downloaded": datetime.datetime.utcnow(), "size": size, "dimension": dimension}
+        immunespace_download_entries.append(immunespace_download_entry)
+    # phenotypes go in before the download is recorded, so a recorded download always has all of its phenotypes
+    for immunespace_download_entry in immunespace_download_entries:
+        if immunespace_download_entry["file_type"] == FileType.datasetProperties:
+            number_of_phenotypes = load_phenotypes(immunespace_download_id, immunespace_download_entry["object_id"],
+                                                   os.path.join(local_path, immunespace_download_entry["file_name"]))
+            immunespace_download_entry["phenotypes_loaded"] = True
+            progress_broker.publish(immunespace_download_id, "phenotypes_loaded", stage="ingest", rows=number_of_phenotypes)
+    with tracer.span("mongo.insert_many", collection="immunespace_downloads", rows=len(immunespace_download_entries)):
+        try:
+            mongo_db_immunespace_downloads_column.insert_many(immunespace_download_entries)
+        except Exception:
+            # nothing would reference the phenotypes loaded above, and /delete couldn't reach them
+            for immunespace_download_entry in immunespace_download_entries:
+                if immunespace_download_entry.get("phenotypes_loaded", False):
+                    mongo_db_immunespace_phenotypes_column.delete_many({"object_id": immunespace_download_entry["object_id"]})
+            raise
+    for immunespace_download_entry in immunespace_download_entries:
+        progress_broker.publish(immunespace_download_id, "file_recorded", stage="ingest", file_name=immunespace_download_entry["file_name"],
+                                size=immunespace_download_entry["size"], dimension=immunespace_download_entry["dimension"])
+
+
+def load_phenotypes(immunespace_download_id: str, object_id: str, file_path: str, batch_size: int = 1000):
+    '''
+    Loads the rows of a phenoDataMatrix.csv into the phenotypes collection, keyed by the object_id of that file, so samples can be selected
+    by cohort, timepoint or biosample without downloading the file. Returns the number of rows loaded.
+    Rows left by an earlier, interrupted load are replaced, and a load that fails removes what it inserted.
+    '''
+    number_of_rows = 0
+    with tracer.span("mongo.insert_many", collection="immunespace_phenotypes", file_path=file_path) as span:
+        mongo_db_immunespace_phenotypes_column.delete_many({"object_id": object_id})
+        try:
+            with open(file_path) as f:
+                batch = []
+                for row in read_phenotype_rows(f):
+                    batch.append(dict(row, object_id=object_id, immunespace_download_id=immunespace_download_id))
+                    if len(batch) == batch_size:
+                        mongo_db_immunespace_phenotypes_column.insert_many(batch)
+                        number_of_rows += len(batch)
+                        batch = []
+                if len(batch) > 0:
+                    mongo_db_immunespace_phenotypes_column.insert_many(batch)
+                    number_of_rows += len(batch)
+        except Exception:
+            mongo_db_immunespace_phenotypes_column.delete_many({"object_id": object_id})
+            raise
+        span.set_attribute("rows", number_of_rows)
+    return number_of_rows
+
+
+def backfill_phenotypes(immunespace_download_id: str, object_id: str, file_path: str):
+    load_phenotypes(immunespace_download_id, object_id, file_path)
+    mongo_db_immunespace_downloads_column.update_one({"object_id": object_id}, {"$set": {"phenotypes_loaded": True}})
+
+
+@app.post("/submit/batch", summary="Download many ImmuneSpace participant groups for one submitter")
+async def submit_batch(parameters: BatchProviderParameters = Depends(BatchProviderParameters.as_form)):
+    '''
+    Accession ids that were already downloaded for this submitter are recorded as `existing` and not downloaded again; the rest are
+    scheduled in the background, sharing the download slots fairly with other submitters. The whole batch is checked against the
+    submitter's quota and the queue depth when it is accepted; if it doesn't fit, nothing is scheduled and 429 is returned, or 413 if
+    the batch is larger than the quota allows at all.
+    <br>**Returns**: the batch_id, to be polled at `/submit/batch/{batch_id}`.
+    '''
+    logger.info(f"parameters: {parameters.submitter_id}, {parameters.accession_ids}")
+    accession_ids = parse_accession_ids(parameters.accession_ids)
+    if len(accession_ids) == 0:
+        raise HTTPException(status_code=400, detail="No accession_ids given")
+
+    existing_query = {"submitter_id": parameters.submitter_id, "accession_id": {"$in": accession_ids}, "apikey": parameters.apikey,
+                      "file_type": FileType.datasetGeneExpression}
+    existing = {entry["accession_id"]: entry["immunespace_download_id"]
+                for entry in mongo_db_immunespace_downloads_column.find(existing_query, {"_id": 0, "accession_id": 1, "immunespace_download_id": 1})}
+
+    batch_id = str(uuid.uuid4())
+    now = datetime.datetime.utcnow()
+    items = batch_items(accession_ids, existing, now)
+    try:
+        admission_controller.check(parameters.submitter_id, count=len([item for item in items if item["status"] == "queued"]))
+    except AdmissionRejected as e:
+        logger.info(f"rejected batch from {parameters.submitter_id}: {e.reason}")
+        if e.retry_after is None:
+            raise HTTPException(status_code=413, detail=f"{e.reason}; split the batch")
+        raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+    mongo_db_immunespace_download_batches_column.insert_one({"batch_id": batch_id, "submitter_id": parameters.submitter_id, "date_created": now, "items": items})
 
-                with open(file_path) as f:
-                    number_of_rows = len(f.readlines())
-                f.close()
+    for item in items:
+        if item["status"] == "queued":
+            task = asyncio.ensure_future(run_batch_item(batch_id=batch_id, submitter_id=parameters.submitter_id, accession_id=item["accession_id"], apikey=parameters.apikey))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
 
-                size = os.path.getsize(file_path)
-                dimension = f"{number_of_rows}x{number_of_columns}"
+    return batch_status(mongo_db_immunespace_download_batches_column.find_one({"batch_id": batch_id}, {"_id": 0}))
 
-                immunespace_download_entry = {"immunespace_download_id": immunespace_download_id, "submitter_id": parameters.submitter_id,
-                                              "data_type": DataType.geneExpression, "object_id": str(uuid.uuid4()), "accession_id": parameters.accession_id,
-                                              "apikey": parameters.apikey, "file_type": file_type, "file_name": file_name,
-                                              "date_downloaded": datetime.datetime.utcnow(), "size": size, "dimension": dimension, "stderr": stderr}
-                mongo_db_immunespace_downloads_column.insert_one(immunespace_download_entry)
 
-        immunespace_download_query = {"submitter_id": parameters.submitter_id, "accession_id": parameters.accession_id,
-                                      "apikey": parameters.apikey, "file_type": parameters.file_type}
+async def run_batch_item(batch_id: str, submitter_id: str, accession_id: str, apikey: str):
+    item_query = {"batch_id": batch_id, "items.accession_id": accession_id}
 
-        projection = {"_id": 0, "immunespace_download_id": 1, "object_id": 1, "submitter_id": 1, "accession_id": 1, "apikey": 1, "status": 1, "data_type": 1,
-                      "file_type": 1, "file_name": 1, "size": 1, "dimension": 1, "stderr": 1, "date_downloaded": 1}
-        found_immunespace_download = mongo_db_immunespace_downloads_column.find_one(immunespace_download_query, projection)
+    def admitted(immunespace_download_id: str):
+        # only a queued item moves to running; the callback can run after the item was already written finished
+        queued_item_query = {"batch_id": batch_id, "items": {"$elemMatch": {"accession_id": accession_id, "status": "queued"}}}
+        mongo_db_immunespace_download_batches_column.update_one(queued_item_query, {"$set": {"items.$.status": "running", "items.$.immunespace_download_id": immunespace_download_id,
+                                                                                          "items.$.date_started": datetime.datetime.utcnow()}})
 
-        # contents = Contents(id=found_immunespace_download["object_id"], name=found_immunespace_download["file_name"],
-        # drs_uri=f"http://localhost:{os.getenv('API_PORT')}/files/{found_immunespace_download['object_id']}")
+    try:
+        with tracer.span("submit_batch_item", batch_id=batch_id, submitter_id=submitter_id, accession_id=accession_id) as span:
+            # the batch was checked against the quota when it was accepted
+            immunespace_download_id = await ensure_immunespace_download(submitter_id=submitter_id, accession_id=accession_id, apikey=apikey, enforce_quota=False,
+                                                                        on_admitted=admitted)
+            span.set_attribute("immunespace_download_id", immunespace_download_id)
+        update = {"items.$.status": "finished", "items.$.immunespace_download_id": immunespace_download_id}
+    except Exception as e:
+        logger.exception(e)
+        update = {"items.$.status": "failed", "items.$.error": f"{e}"}
+    update["items.$.date_finished"] = datetime.datetime.utcnow()
+    mongo_db_immunespace_download_batches_column.update_one(item_query, {"$set": update})
 
-        ret = ProviderResponse(id=found_immunespace_download["object_id"],
-                               object_id=found_immunespace_download["object_id"],
-                               submitter_id=found_immunespace_download["submitter_id"],
-                               size=found_immunespace_download["size"],
-                               dimension=found_immunespace_download["dimension"],
-                               name=found_immunespace_download['file_name'],
-                               self_uri=f"http://localhost:{os.getenv('API_PORT')}/objects/{found_immunespace_download['object_id']}",
-                               data_type=found_immunespace_download["data_type"],
-                               file_type=found_immunespace_download["file_type"],
-                               created_time=f"{found_immunespace_download['date_downloaded']}",
-                               mime_type="application/csv", status="finished",
-                               contents=[], stderr=found_immunespace_download['stderr'])
 
-        return vars(ret)
+@app.get("/admission", summary="Queue depth, running downloads and wait times of the download scheduler")
+async def admission():
+    return admission_controller.stats()
 
-    except Exception as e:
-        logger.exception(e)
-        return HTTPException(status_code=404, detail="Not found")
 
+@app.get("/submit/batch/{batch_id}", summary="Get aggregate and per-accession status of a batch submit")
+async def get_submit_batch(batch_id: str):
+    batch = mongo_db_immunespace_download_batches_column.find_one({"batch_id": batch_id}, {"_id": 0})
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return batch_status(batch)
 
-def run_immunespace_download(immunespace_download_id: str, accession_id: str, apikey: str):
-    stderr = ""
+
+PIPELINE_STAGES = ["immunespace-groups", "immunespace-mapper"]
+
+
+def run_container(immunespace_download_id: str, stage: str, stage_number: int, image: str, command: str):
+    '''
+    Runs one pipeline container, following its log stream so each line is published as a progress event while the container runs.
+    Returns the decoded container output.
+    '''
     volumes = {
         "immunespace-download-data": {'bind': '/data', 'mode': 'rw'}
     }
+    progress_broker.publish(immunespace_download_id, "stage_started", stage=stage, stage_number=stage_number, number_of_stages=len(PIPELINE_STAGES), image=image)
+    with tracer.span("docker.containers.run", image=image) as span:
+        container = docker_client.containers.run(image, volumes=volumes, name=f"{immunespace_download_id}-{stage}",
+                                                 working_dir=f"/data/{immunespace_download_id}",
+                                                 privileged=True, command=command, detach=True)
+        try:
+            decoder = LogLineDecoder()
+            lines = []
+            number_of_bytes = 0
+            with tracer.span("docker.logs.decode", image=image) as decode_span:
+                for chunk in container.logs(stream=True, follow=True):
+                    number_of_bytes += len(chunk)
+                    for line in decoder.feed(chunk):
+                        lines.append(line)
+                        progress_broker.publish(immunespace_download_id, "log", stage=stage, line=line, line_number=len(lines))
+                for line in decoder.flush():
+                    lines.append(line)
+                    progress_broker.publish(immunespace_download_id, "log", stage=stage, line=line, line_number=len(lines))
+                decode_span.set_attributes(bytes=number_of_bytes, lines=len(lines))
+            exit_status = container.wait()
+            span.set_attribute("exit_code", exit_status.get("StatusCode"))
+        finally:
+            container.remove(force=True)
+    container_logs_decoded = "".join(f"{line}\n" for line in lines)
+    progress_broker.publish(immunespace_download_id, "stage_finished", stage=stage, stage_number=stage_number, number_of_stages=len(PIPELINE_STAGES),
+                            bytes=number_of_bytes, lines=len(lines), exit_code=exit_status.get("StatusCode"))
+    logger.info(msg=f"finished {image}")
+    if exit_status.get("StatusCode") != 0:
+        raise Exception(f"There was a problem running the {image} container, exit status {exit_status.get('StatusCode')}")
+    return container_logs_decoded
+
+
+def run_immunespace_download(immunespace_download_id: str, accession_id: str, apikey: str):
+    stderr = ""
     image = "txscience/tx-immunespace-groups:0.3"
     command = f"-g \"{accession_id}\" -a \"{apikey}\" -o /data/{immunespace_download_id}"
-    immunespace_groups_container_logs = docker_client.containers.run(image, volumes=volumes, name=f"{immunespace_download_id}-immunespace-groups",
-                                                                     working_dir=f"/data/{immunespace_download_id}",
-                                                                     privileged=True, remove=True, command=command, detach=False)
-    immunespace_groups_container_logs_decoded = immunespace_groups_container_logs.decode("utf8")
+    immunespace_groups_container_logs_decoded = run_container(immunespace_download_id, stage="immunespace-groups", stage_number=1, image=image, command=command)
     stderr += immunespace_groups_container_logs_decoded
-    logger.info(msg=f"finished txscience/tx-immunespace-groups:0.3")
     if immunespace_groups_container_logs_decoded.__contains__("returned non-zero exit status"):
         raise Exception("There was a problem running the txscience/tx-immunespace-groups container")
 
     image = "txscience/fuse-mapper-immunespace:0.1"
     command = f"-g /data/{immunespace_download_id}/geneBySampleMatrix.csv -p /data/{immunespace_download_id}/phenoDataMatrix.csv"
-    mapper_container_logs = docker_client.containers.run(image, volumes=volumes, name=f"{immunespace_download_id}-immunespace-mapper",
-                                                         working_dir=f"/data/{immunespace_download_id}",
-                                                         privileged=True, remove=True, command=command, detach=False)
-    logger.info(msg=f"finished fuse-mapper-immunespace:0.1")
-    mapper_container_logs_decoded = mapper_container_logs.decode("utf8")
+    mapper_container_logs_decoded = run_container(immunespace_download_id, stage="immunespace-mapper", stage_number=2, image=image, command=command)
     stderr += mapper_container_logs_decoded
-    logger.debug(msg=f"stderr: {stderr}")
+    logger.debug(msg=f"stderr length: {len(stderr)}")
     return stderr
 
 
+def save_immunespace_download_log(immunespace_download_id: str, stderr: str):
+    '''
+    Container output is stored once per download, apart from the per-file records, and is only read by the /logs endpoint.
+    '''
+    stderr, truncated = utf8_tail(stderr, max_stderr_bytes)
+    immunespace_download_log_entry = {"immunespace_download_id": immunespace_download_id, "stderr": stderr, "truncated": truncated,
+                                      "date_created": datetime.datetime.utcnow()}
+    with tracer.span("mongo.replace_one", collection="immunespace_download_logs", bytes=len(stderr.encode("utf8"))):
+        mongo_db_immunespace_download_logs_column.replace_one({"immunespace_download_id": immunespace_download_id}, immunespace_download_log_entry, upsert=True)
+
+
+@app.get("/logs/{object_id}", summary="Get the container output recorded while downloading an object")
+async def logs(object_id: str):
+    entry = mongo_db_immunespace_downloads_column.find_one({"object_id": object_id}, {"_id": 0, "immunespace_download_id": 1})
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    immunespace_download_id = entry["immunespace_download_id"]
+    projection = {"_id": 0, "immunespace_download_id": 1, "stderr": 1, "truncated": 1, "date_created": 1}
+    found_immunespace_download_log = mongo_db_immunespace_download_logs_column.find_one({"immunespace_download_id": immunespace_download_id}, projection)
+    if found_immunespace_download_log is None:
+        # downloads recorded before logs were split out still carry them on the object record
+        legacy_entry = mongo_db_immunespace_downloads_column.find_one({"object_id": object_id}, {"_id": 0, "stderr": 1})
+        if legacy_entry is None or legacy_entry.get("stderr") is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        found_immunespace_download_log = {"immunespace_download_id": immunespace_download_id, "stderr": legacy_entry["stderr"], "truncated": False}
+    return found_immunespace_download_log
+
+
+@app.get("/progress", summary="List downloads that are currently running")
+async def progress_jobs(submitter_id: str = Query(default=None, description="only list downloads for this submitter"),
+                        include_finished: bool = Query(default=False, description="also list recently finished downloads")):
+    return [job for job in progress_broker.jobs(include_finished=include_finished) if submitter_id is None or job.get("submitter_id") == submitter_id]
+
+
+@app.get("/progress/{immunespace_download_id}", summary="Stream progress events for a download as Server-Sent Events")
+async def progress(immunespace_download_id: str):
+    '''
+    Replays the events seen so far for the download and then follows it live until it finishes or fails.
+    Events are `started`, `queued` (with the download's `position` in its submitter's queue and `estimated_wait_seconds`), `admitted`,
+    `stage_started`, `log`, `stage_finished`, `phenotypes_loaded` (with the number of `rows`), `file_recorded`, `finished` and `failed`;
+    each data payload is a JSON object.
+    A download can be followed from the moment it is queued; batch items carry their `immunespace_download_id` once admitted.
+    '''
+    if not progress_broker.exists(immunespace_download_id):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    async def event_stream():
+        async for message in progress_broker.subscribe(immunespace_download_id):
+            yield sse_format(message)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/phenotypes/{object_id}", summary="Select samples of a download by phenotype")
+async def phenotypes(object_id: str = Path(default="", description="object_id of either file of a download"),
+                     cohort: list[str] = Query(default=None, description="only samples in these cohorts"),
+                     study_time_collected: list[str] = Query(default=None, description="only samples collected at these timepoints"),
+                     biosample_accession: list[str] = Query(default=None, description="only these biosamples"),
+                     participant_id: list[str] = Query(default=None, description="only samples from these participants"),
+                     rows: bool = Query(default=False, description="return the matching phenotype rows instead of just their biosample_accession ids")):
+    '''
+    Queries the rows of the download's phenoDataMatrix.csv; repeat a parameter to match any of several values.
+    <br>**Returns**: the matching biosample_accession ids, which select the columns of geneBySampleMatrix.csv, or the full rows if `rows` is true.
+    '''
+    entry = mongo_db_immunespace_downloads_column.find_one({"object_id": object_id}, {"_id": 0, "immunespace_download_id": 1})
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    immunespace_download_id = entry["immunespace_download_id"]
+    properties_query = {"immunespace_download_id": immunespace_download_id, "file_type": FileType.datasetProperties}
+    properties_entry = mongo_db_immunespace_downloads_column.find_one(properties_query, {"_id": 0, "object_id": 1, "file_name": 1, "phenotypes_loaded": 1})
+    if properties_entry is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    properties_object_id = properties_entry["object_id"]
+
+    if not properties_entry.get("phenotypes_loaded", False):
+        # downloads ingested before phenotypes were loaded get backfilled on first query; the download is only marked once the load
+        # completes, so an interrupted backfill is redone, and concurrent first queries wait on the one backfill already in flight
+        file_path = os.path.abspath(f"/app/data/{immunespace_download_id}/{properties_entry['file_name']}")
+        if os.path.exists(file_path):
+            in_flight = in_flight_phenotype_loads.get(properties_object_id)
+            if in_flight is None:
+                in_flight = asyncio.ensure_future(run_in_threadpool(backfill_phenotypes, immunespace_download_id, properties_object_id, file_path))
+                in_flight_phenotype_loads[properties_object_id] = in_flight
+                in_flight.add_done_callback(lambda _: in_flight_phenotype_loads.pop(properties_object_id, None))
+            await asyncio.shield(in_flight)
+
+    query = phenotype_query(properties_object_id, cohort=cohort, study_time_collected=study_time_collected,
+                            biosample_accession=biosample_accession, participant_id=participant_id)
+    if rows:
+        return list(mongo_db_immunespace_phenotypes_column.find(query, {"_id": 0, "object_id": 0, "immunespace_download_id": 0}))
+    return [row["biosample_accession"] for row in mongo_db_immunespace_phenotypes_column.find(query, {"_id": 0, "biosample_accession": 1}) if "biosample_accession" in row]
+
+
 @app.get("/files/{object_id}")
 async def files(object_id: str):
     query = {"object_id": object_id}
@@ -378,6 +762,8 @@ async def delete(object_id: str):
 
             task_query = {"immunespace_download_id": found_immunespace_download["immunespace_download_id"]}
             ret = mongo_db_immunespace_downloads_column.delete_many(task_query)
+            mongo_db_immunespace_download_logs_column.delete_many(task_query)
+            mongo_db_immunespace_phenotypes_column.delete_many(task_query)
             # <class 'pymongo.results.DeleteResult'>
             delete_status = "deleted"
             if not ret.acknowledged:
@@ -0,0 +1,186 @@
+import asyncio
+import pathlib
+
+import pytest
+
+from fuse.utils.admission import AdmissionController, AdmissionRejected, admission_controller_from_env
+
+
+class FakeExecutor:
+    '''
+    Simulates long pipeline runs, recording the order in which they were admitted.
+    '''
+
+    def __init__(self, controller: AdmissionController, job_seconds: float = 0.05):
+        self.controller = controller
+        self.job_seconds = job_seconds
+        self.started = []
+        self.peak_running = 0
+
+    async def run(self, submitter_id: str, name: str, enforce_quota: bool = True):
+        async with self.controller.slot(submitter_id, enforce_quota=enforce_quota):
+            self.started.append(name)
+            self.peak_running = max(self.peak_running, self.controller.running)
+            await asyncio.sleep(self.job_seconds)
+
+
+def test_global_limit_and_fair_order():
+    controller = AdmissionController(max_running=1, max_running_per_submitter=1, max_queued_per_submitter=10)
+    executor = FakeExecutor(controller)
+
+    async def run():
+        jobs = [executor.run("greedy", f"greedy-{i}") for i in range(4)] + [executor.run("other", f"other-{i}") for i in range(2)]
+        await asyncio.gather(*jobs)
+
+    asyncio.run(run())
+    assert executor.peak_running == 1
+    # the second submitter gets every other slot instead of waiting behind all of greedy's jobs
+    assert executor.started[:5] == ["greedy-0", "other-0", "greedy-1", "other-1", "greedy-2"]
+    assert controller.running == 0 and controller.queued == 0
+
+
+def test_per_submitter_running_limit():
+    controller = AdmissionController(max_running=4, max_running_per_submitter=2)
+    executor = FakeExecutor(controller)
+
+    async def run():
+        await asyncio.gather(*[executor.run("a", f"a-{i}") for i in range(5)])
+
+    asyncio.run(run())
+    assert executor.peak_running == 2
+
+
+def test_quota_rejects_with_retry_after():
+    controller = AdmissionController(max_running=1, max_running_per_submitter=1, max_queued_per_submitter=2, default_job_seconds=30)
+    executor = FakeExecutor(controller, job_seconds=0.1)
+
+    async def run():
+        jobs = [asyncio.ensure_future(executor.run("a", f"a-{i}")) for i in range(2)]
+        await asyncio.sleep(0.01)
+        assert controller.stats()["submitters"]["a"] == {"running": 1, "queued": 1}
+        with pytest.raises(AdmissionRejected) as rejected:
+            await executor.run("a", "a-2")
+        # accepted runs, like batch items, bypass the quota and wait their turn
+        await asyncio.gather(*jobs, executor.run("a", "a-3", enforce_quota=False))
+        return rejected.value
+
+    rejected = asyncio.run(run())
+    assert rejected.retry_after == 60
+    assert controller.stats()["wait_seconds"]["count"] == 3
+
+
+def test_cancelled_waiter_leaves_queue():
+    controller = AdmissionController(max_running=1)
+    executor = FakeExecutor(controller)
+
+    async def run():
+        first = asyncio.ensure_future(executor.run("a", "a-0"))
+        second = asyncio.ensure_future(executor.run("b", "b-0"))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await first
+        return controller.queued
+
+    assert asyncio.run(run()) == 0
+
+
+def test_competing_batches_share_slots():
+    controller = AdmissionController(max_running=4, max_running_per_submitter=2)
+    executor = FakeExecutor(controller)
+
+    async def run():
+        # batch items were accepted up front, so they queue without quota checks
+        batch_a = [asyncio.ensure_future(executor.run("a", f"a-{i}", enforce_quota=False)) for i in range(20)]
+        await asyncio.sleep(0.01)
+        batch_b = [asyncio.ensure_future(executor.run("b", f"b-{i}", enforce_quota=False)) for i in range(5)]
+        await asyncio.gather(*batch_a, *batch_b)
+
+    asyncio.run(run())
+    assert executor.peak_running == 4
+    assert executor.started[:4] == ["a-0", "a-1", "b-0", "b-1"]
+    # b's items are interleaved with a's instead of waiting behind the whole of a's batch
+    assert executor.started.index("b-4") < executor.started.index("a-10")
+
+
+def test_check_counts_whole_batch():
+    controller = AdmissionController(max_running=2, max_queued_per_submitter=10, max_queue_depth=100)
+    controller.check("a", count=10)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.check("a", count=11)
+    # a batch over the quota can never fit, so there is nothing to retry
+    assert rejected.value.retry_after is None
+    # 2 of the 8 start right away, leaving 6 waiting
+    with pytest.raises(AdmissionRejected):
+        AdmissionController(max_running=2, max_queued_per_submitter=10, max_queue_depth=5).check("b", count=8)
+
+
+def test_batch_waits_for_the_submitters_own_runs():
+    controller = AdmissionController(max_running=1, max_queued_per_submitter=10)
+
+    async def run():
+        tickets = [controller.request("a") for _ in range(5)]
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.check("a", count=6)
+        for ticket in tickets:
+            controller.cancel(ticket)
+        controller.check("a", count=6)
+        return rejected.value
+
+    assert asyncio.run(run()).retry_after >= 1
+
+
+@pytest.mark.parametrize("use_sample_env", [False, True])
+def test_shipped_limits_accept_large_batches(monkeypatch, use_sample_env):
+    for name in ["ADMISSION_MAX_RUNNING", "ADMISSION_MAX_RUNNING_PER_SUBMITTER", "ADMISSION_MAX_QUEUED_PER_SUBMITTER", "ADMISSION_MAX_QUEUE_DEPTH"]:
+        monkeypatch.delenv(name, raising=False)
+    if use_sample_env:
+        for line in (pathlib.Path(__file__).parents[3] / "sample.env").read_text().splitlines():
+            (name, _, value) = line.partition("=")
+            if name.startswith("ADMISSION_"):
+                monkeypatch.setenv(name, value)
+    controller = admission_controller_from_env()
+    controller.check("a", count=20)
+    controller.check("a", count=50)
+
+
+def test_position_in_submitter_queue():
+    controller = AdmissionController(max_running=1)
+
+    async def run():
+        tickets = [controller.request("a") for _ in range(3)]
+        return [controller.position(ticket) for ticket in tickets]
+
+    assert asyncio.run(run()) == [0, 1, 2]
+
+
+def test_cancelled_ticket_frees_its_slot():
+    controller = AdmissionController(max_running=1)
+
+    async def run():
+        ticket = controller.request("a")
+        assert ticket.waiter.done() and controller.running == 1
+        waiting = controller.request("b")
+        assert not waiting.waiter.done()
+        controller.cancel(ticket)
+        assert waiting.waiter.done()
+        controller.cancel(waiting)
+        return controller.running, controller.queued
+
+    assert asyncio.run(run()) == (0, 0)
+
+
+def test_release_skips_waiters_cancelled_before_they_left_the_queue():
+    controller = AdmissionController(max_running=1)
+
+    async def run():
+        running = controller.request("a")
+        waiting = [controller.request("b"), controller.request("c")]
+        # as at shutdown: cancelling a waiting task cancels its waiter before the task gets to discard it
+        waiting[0].waiter.cancel()
+        controller.cancel(running)
+        assert waiting[1].waiter.done() and not waiting[1].waiter.cancelled()
+        controller.cancel(waiting[0])
+        controller.cancel(waiting[1])
+        return controller.running, controller.queued
+
+    assert asyncio.run(run()) == (0, 0)
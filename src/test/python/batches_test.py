@@ -0,0 +1,31 @@
+import datetime
+
+from fuse.utils.batches import parse_accession_ids, batch_items, batch_status
+
+now = datetime.datetime(2022, 3, 1)
+
+
+def item(status: str):
+    return {"accession_id": status, "status": status}
+
+
+def test_parse_accession_ids_dedupes_in_order():
+    assert parse_accession_ids("grp2, grp1,,grp2 ,grp3") == ["grp2", "grp1", "grp3"]
+    assert parse_accession_ids(" , ") == []
+
+
+def test_batch_items_skip_existing_downloads():
+    items = batch_items(["grp1", "grp2"], {"grp1": "abcd1234"}, now)
+    assert items[0] == {"accession_id": "grp1", "status": "existing", "immunespace_download_id": "abcd1234", "error": None,
+                        "date_started": None, "date_finished": now}
+    assert items[1]["status"] == "queued" and items[1]["immunespace_download_id"] is None and items[1]["date_finished"] is None
+
+
+def test_batch_status():
+    assert batch_status({"items": [item("existing"), item("queued")]})["status"] == "running"
+    assert batch_status({"items": [item("finished"), item("running")]})["status"] == "running"
+    assert batch_status({"items": [item("finished"), item("existing")]})["status"] == "finished"
+    assert batch_status({"items": [item("finished"), item("failed")]})["status"] == "partial"
+    assert batch_status({"items": [item("failed"), item("failed")]})["status"] == "failed"
+    counts = batch_status({"batch_id": "b", "items": [item("failed"), item("existing"), item("existing")]})["counts"]
+    assert counts == {"queued": 0, "running": 0, "finished": 0, "failed": 1, "existing": 2}
@@ -9,6 +9,8 @@ import requests
 from labkey.api_wrapper import APIWrapper
 from labkey.query import QueryFilter
 
+from fuse.utils.merge import merge_run_matrix_files, write_merged_matrix
+
 api = APIWrapper(domain="www.immunespace.org", container_path="Studies", use_ssl=True, api_key="apikey|01a141db71869525cbf60a5a333edd31", disable_csrf=True)
 
 
@@ -104,6 +106,7 @@ def main():
 
     biosample_accessions = list()
     gene_expressions = dict()
+    run_files = list()
 
     for r in selected_runs_results["rows"]:
 
@@ -158,6 +161,7 @@ def main():
         print("writing %s " % gene_expression_csv_path)
 
         with open(gene_expression_csv_path, "w") as csv_file:
+            csv_file.write("gene,%s\n" % ",".join(features))
             for (idx, gene_name) in enumerate(gene_names):
                 relevant_lines = list(filter(lambda x: x.split(",")[0] == gene_name, lines))
                 if len(relevant_lines) > 1:
@@ -172,6 +176,14 @@ def main():
                 csv_file.write("%s\n" % merged_line)
                 print("finished: %s/%s" % (idx, len(gene_names)))
         csv_file.close()
+        run_files.append((str(run_id), str(feature_set_id), gene_expression_csv_path))
+
+    # each run can cover a different gene set; outer-join them into one gene x sample matrix
+    merged = merge_run_matrix_files(run_files)
+    merged_csv_path = os.path.join('/tmp', 'geneBySampleMatrix.csv')
+    sample_run_mapping_csv_path = os.path.join('/tmp', 'sampleRunMapping.csv')
+    print("writing %s (%sx%s) and %s" % (merged_csv_path, len(merged.genes), len(merged.samples), sample_run_mapping_csv_path))
+    write_merged_matrix(merged, merged_csv_path, sample_run_mapping_csv_path)
 
     print("biosample_accessions: %s" % biosample_accessions)
     print("gene_expressions: %s" % gene_expressions)
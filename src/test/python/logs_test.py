@@ -0,0 +1,19 @@
+from fuse.utils.logs import utf8_tail
+
+
+def test_short_logs_are_kept():
+    assert utf8_tail("all of it\n", 100) == ("all of it\n", False)
+
+
+def test_tail_is_limited_by_encoded_bytes():
+    text = "☃" * 10 + "end"
+    tail, truncated = utf8_tail(text, 10)
+    assert truncated
+    assert len(tail.encode("utf8")) <= 10
+    # a 3-byte snowman split by the cut is dropped rather than decoded as garbage
+    assert tail == "☃☃end"
+
+
+def test_tail_on_character_boundary():
+    tail, truncated = utf8_tail("ab☃", 3)
+    assert (tail, truncated) == ("☃", True)
@@ -0,0 +1,41 @@
+import csv
+
+import numpy
+import pytest
+
+from fuse.utils.merge import RunMatrix, merge_run_matrices, merge_run_matrix_files, write_merged_matrix
+
+
+def test_merge_outer_joins_on_genes():
+    merged = merge_run_matrices([RunMatrix("r1", ["B", "A"], ["BS1"], [[2.0], [1.0]], batch="fs1"),
+                                 RunMatrix("r2", ["A", "C"], ["BS2", "BS3"], [[3.0, 4.0], [5.0, 6.0]])])
+    assert merged.genes == ["A", "B", "C"]
+    assert merged.samples == ["BS1", "BS2", "BS3"]
+    expected = numpy.array([[1.0, 3.0, 4.0], [2.0, numpy.nan, numpy.nan], [numpy.nan, 5.0, 6.0]])
+    numpy.testing.assert_array_equal(merged.values, expected)
+    assert merged.sample_runs == [("BS1", "r1", "fs1"), ("BS2", "r2", "r2"), ("BS3", "r2", "r2")]
+
+
+def test_merge_rejects_duplicate_genes():
+    with pytest.raises(ValueError):
+        merge_run_matrices([RunMatrix("r1", ["A", "A"], ["BS1"], [[1.0], [2.0]])])
+
+
+def test_merge_files_matches_in_memory_merge(tmp_path):
+    run1 = tmp_path / "run1.csv"
+    run1.write_text("gene,BS1,BS2\nA,1,2\nC,3,NA\n")
+    run2 = tmp_path / "run2.csv"
+    run2.write_text("gene,BS3\nB,4\nC,5\n")
+    merged = merge_run_matrix_files([("r1", "fs1", str(run1)), ("r2", "fs2", str(run2))])
+    in_memory = merge_run_matrices([RunMatrix("r1", ["A", "C"], ["BS1", "BS2"], [[1, 2], [3, numpy.nan]], batch="fs1"),
+                                    RunMatrix("r2", ["B", "C"], ["BS3"], [[4], [5]], batch="fs2")])
+    assert merged.genes == in_memory.genes and merged.samples == in_memory.samples and merged.sample_runs == in_memory.sample_runs
+    numpy.testing.assert_array_equal(merged.values, in_memory.values)
+
+    matrix_path = tmp_path / "geneBySampleMatrix.csv"
+    mapping_path = tmp_path / "sampleRunMapping.csv"
+    write_merged_matrix(merged, str(matrix_path), str(mapping_path), float_format="{:g}")
+    with open(matrix_path) as f:
+        assert list(csv.reader(f)) == [["gene", "BS1", "BS2", "BS3"], ["A", "1", "2", "NA"], ["B", "NA", "NA", "4"], ["C", "3", "NA", "5"]]
+    with open(mapping_path) as f:
+        assert list(csv.reader(f))[1] == ["BS1", "r1", "fs1"]
@@ -0,0 +1,23 @@
+from fuse.utils.phenotypes import read_phenotype_rows, phenotype_query
+
+
+def test_read_phenotype_rows():
+    lines = ["participant_id,study_time_collected,study_time_collected_unit,cohort,cohort_type,biosample_accession\n",
+             "SUB1,0,Days,young,x,BS1\n",
+             "SUB1,7.5,Days,young,x,BS2\n",
+             "\n",
+             "SUB2,NA,Days,old,x,BS3\n"]
+    rows = list(read_phenotype_rows(lines))
+    assert [row["biosample_accession"] for row in rows] == ["BS1", "BS2", "BS3"]
+    assert [row["study_time_collected"] for row in rows] == [0, 7.5, "NA"]
+    assert rows[0]["cohort"] == "young"
+
+
+def test_read_phenotype_rows_empty_file():
+    assert list(read_phenotype_rows([])) == []
+
+
+def test_phenotype_query():
+    assert phenotype_query("o1") == {"object_id": "o1"}
+    assert phenotype_query("o1", cohort=["young"], study_time_collected=["0", "7"]) == {"object_id": "o1", "cohort": "young",
+                                                                                        "study_time_collected": {"$in": [0, 7]}}
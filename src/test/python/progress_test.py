@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+from fuse.utils.progress import ProgressBroker, LogLineDecoder, sse_format
+
+
+def test_log_line_decoder_handles_split_chunks():
+    decoder = LogLineDecoder()
+    snowman = "☃".encode("utf8")
+    assert decoder.feed(b"first li") == []
+    assert decoder.feed(b"ne\nsecond " + snowman[:1]) == ["first line"]
+    assert decoder.feed(snowman[1:] + b"\nthird") == ["second ☃"]
+    assert decoder.flush() == ["third"]
+
+
+def test_subscribers_replay_history_and_follow_live_events():
+    broker = ProgressBroker()
+    broker.start("job", submitter_id="a@b.c")
+    broker.publish("job", "log", line="one")
+
+    async def collect():
+        return [message["event"] async for message in broker.subscribe("job")]
+
+    async def run():
+        subscribers = [asyncio.ensure_future(collect()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        publisher = threading.Thread(target=lambda: (broker.publish("job", "log", line="two"), broker.publish("job", "finished")))
+        publisher.start()
+        results = await asyncio.wait_for(asyncio.gather(*subscribers), timeout=5)
+        publisher.join()
+        return results
+
+    for events in asyncio.run(run()):
+        assert events == ["started", "log", "log", "finished"]
+    assert broker.jobs() == []
+    assert broker.jobs(include_finished=True)[0]["submitter_id"] == "a@b.c"
+
+
+def test_late_subscriber_gets_finished_history():
+    broker = ProgressBroker()
+    broker.start("job")
+    broker.publish("job", "failed", error="boom")
+
+    async def collect():
+        return [message async for message in broker.subscribe("job")]
+
+    messages = asyncio.run(collect())
+    assert [m["event"] for m in messages] == ["started", "failed"]
+    assert sse_format(messages[-1]).startswith("event: failed\ndata: ")
+
+
+def test_rerun_is_not_evicted_by_its_earlier_run():
+    broker = ProgressBroker(retain_finished_jobs=1)
+    broker.start("x")
+    broker.publish("x", "finished")
+    broker.start("x")
+    broker.start("y")
+    broker.publish("y", "finished")
+    assert broker.exists("x")
+    broker.publish("x", "finished")
+    assert [job["job_id"] for job in broker.jobs(include_finished=True)] == ["x"]
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from fuse.utils.tracing import Tracer, SpanExporter, FileSpanExporter
+
+
+class ListSpanExporter(SpanExporter):
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans: list):
+        self.traces.append(spans)
+
+
+def test_nested_spans_share_trace():
+    exporter = ListSpanExporter()
+    tracer = Tracer(exporter=exporter)
+    with tracer.span("submit") as root:
+        with tracer.span("file.stat", bytes=10) as child:
+            child.set_attribute("rows", 3)
+    assert len(exporter.traces) == 1
+    spans = exporter.traces[0]
+    assert [s.name for s in spans] == ["file.stat", "submit"]
+    assert spans[0].trace_id == root.trace_id and spans[0].parent_id == root.span_id
+    assert spans[0].attributes == {"bytes": 10, "rows": 3}
+
+
+def test_fast_traces_are_dropped_unless_sampled():
+    exporter = ListSpanExporter()
+    tracer = Tracer(exporter=exporter, sample_rate=0.0, slow_threshold_seconds=60)
+    with tracer.span("submit"):
+        pass
+    assert exporter.traces == []
+
+
+def test_failed_traces_are_kept():
+    exporter = ListSpanExporter()
+    tracer = Tracer(exporter=exporter, sample_rate=0.0)
+    with pytest.raises(ValueError):
+        with tracer.span("submit"):
+            raise ValueError("boom")
+    assert exporter.traces[0][0].status == "error"
+
+
+def test_file_exporter(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = Tracer(exporter=FileSpanExporter(str(path)))
+    with tracer.span("submit"):
+        with tracer.span("mongo.find_one"):
+            pass
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["name"] for line in lines] == ["mongo.find_one", "submit"]